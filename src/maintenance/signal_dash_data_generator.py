@@ -8,9 +8,13 @@ import datetime
 import mysql.connector
 import pandas as pd
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from dataclasses import dataclass
 from epiweeks import Week
-from typing import List
+from itertools import chain, starmap
+from operator import attrgetter
+from typing import Iterator, List, Sequence, Tuple
 
 # first party
 import covidcast
@@ -19,16 +23,28 @@ from delphi_utils import get_structured_logger
 
 
 LOOKBACK_DAYS_FOR_COVERAGE = 56
+COVERAGE_FETCH_WORKERS = 8
+COVERAGE_WRITE_BATCH_SIZE = 1000
 BASE_COVIDCAST = covidcast.covidcast.Epidata.BASE_URL + "/covidcast"
 COVERAGE_URL = (f"{BASE_COVIDCAST}/coverage?"
                 + "format=csv"
-                + "&signal={{source}}:{{signal}}" 
-                + "&days={LOOKBACK_DAYS_FOR_COVERAGE}")
+                + "&signal={source}:{signal}"
+                + "&fields=time_value,count"
+                + f"&days={LOOKBACK_DAYS_FOR_COVERAGE}")
+METADATA_COLUMNS = ["data_source", "signal", "time_type", "max_time", "max_issue"]
+METADATA_URL = (covidcast.covidcast.Epidata.BASE_URL + "/covidcast_meta/?"
+                + "format=csv"
+                + "&fields=" + ",".join(METADATA_COLUMNS)
+                + "&signals={signals}")
 
 @dataclass
 class DashboardSignal:
     """Container class for information about dashboard signals."""
 
+    # `dataclass(slots=True)` needs Python 3.10
+    __slots__ = ('db_id', 'name', 'source', 'covidcast_signal',
+                 'latest_coverage_update', 'latest_status_update')
+
     db_id: int
     name: str
     source: str
@@ -41,6 +57,8 @@ class DashboardSignal:
 class DashboardSignalCoverage:
     """Container class for coverage of a dashboard signal"""
 
+    __slots__ = ('signal_id', 'date', 'geo_type', 'count')
+
     signal_id: int
     date: datetime.date
     geo_type: str
@@ -51,6 +69,8 @@ class DashboardSignalCoverage:
 class DashboardSignalStatus:
     """Container class for status of a dashboard signal"""
 
+    __slots__ = ('signal_id', 'date', 'latest_issue', 'latest_time_value')
+
     signal_id: int
     date: datetime.date
     latest_issue: datetime.date
@@ -64,95 +84,174 @@ class Database:
     SIGNAL_TABLE_NAME = 'dashboard_signal'
     STATUS_TABLE_NAME = 'dashboard_signal_status'
     COVERAGE_TABLE_NAME = 'dashboard_signal_coverage'
+    INSERT_BATCH_SIZE = 10000
+    FETCH_BATCH_SIZE = 1000
 
     def __init__(self, connector_impl=mysql.connector):
-        """Establish a connection to the database."""
+        """Prepare a connection to the database, opened on first use."""
+
+        self._connector_impl = connector_impl
+        self._connection = None
+        self._cursor = None
+        self._prepared_cursor = None
+
+    def _ensure_connection(self) -> None:
+        """Establish a connection to the database if there is none yet."""
+        if self._connection is not None:
+            return
 
         u, p = secrets.db.epi
-        self._connection = connector_impl.connect(
+        self._connection = self._connector_impl.connect(
             host=secrets.db.host,
             user=u,
             password=p,
-            database=Database.DATABASE_NAME)
-        self._cursor = self._connection.cursor()
+            database=Database.DATABASE_NAME,
+            # writes are committed together by `flush`
+            autocommit=False)
+        # unbuffered, so that selected rows are streamed from the server
+        self._cursor = self._connection.cursor(buffered=False)
+        # fixed-shape statements are prepared once and executed per row
+        self._prepared_cursor = self._connection.cursor(prepared=True)
+
+    def close(self) -> None:
+        """Close the connection to the database, if any."""
+        if self._connection is None:
+            return
+        self._cursor.close()
+        self._prepared_cursor.close()
+        self._connection.close()
+        self._connection = None
+        self._cursor = None
+        self._prepared_cursor = None
+
+    @contextmanager
+    def session(self) -> Iterator['Database']:
+        """Use one connection for a group of writes.
+
+        Pending writes are committed and the connection is closed on exit. If
+        the body raises, pending writes are rolled back instead.
+        """
+        self._ensure_connection()
+        try:
+            try:
+                yield self
+            except BaseException:
+                self.rollback()
+                raise
+            self.flush()
+        finally:
+            self.close()
 
     def rowcount(self) -> int:
         """Get the last modified row count"""
+        if self._cursor is None:
+            return -1
         return self._cursor.rowcount
 
+    def flush(self) -> None:
+        """Commit all pending writes."""
+        if self._connection is not None:
+            self._connection.commit()
+
+    def rollback(self) -> None:
+        """Discard all pending writes."""
+        if self._connection is not None:
+            self._connection.rollback()
+
+    def _insert_rows(self, insert_template: str, row_placeholder: str,
+                     rows: Sequence[Tuple]) -> None:
+        """Insert rows with one multi-row statement per batch.
+
+        `insert_template` must contain a `{values}` field, which is replaced by
+        one `row_placeholder` per row in the batch.
+        """
+        for start in range(0, len(rows), Database.INSERT_BATCH_SIZE):
+            batch = rows[start:start + Database.INSERT_BATCH_SIZE]
+            values = ", ".join([row_placeholder] * len(batch))
+            self._cursor.execute(
+                insert_template.format(values=values),
+                list(chain.from_iterable(batch)))
+
+    def _update_latest_date(self, column: str, table_name: str,
+                            signal_ids: Sequence[int]) -> None:
+        """Advance `column` of the given signals to their latest date in `table_name`."""
+        if not signal_ids:
+            return
+        id_placeholders = ", ".join(["%s"] * len(signal_ids))
+        update_statement = f'''UPDATE `{Database.SIGNAL_TABLE_NAME}` s
+            JOIN (
+                SELECT `signal_id`, MAX(`date`) AS `max_date`
+                FROM `{table_name}`
+                WHERE `signal_id` IN ({id_placeholders})
+                GROUP BY `signal_id`
+            ) t ON s.`id` = t.`signal_id`
+            SET s.`{column}` = GREATEST(s.`{column}`, t.`max_date`)
+            '''
+        self._cursor.execute(update_statement, list(signal_ids))
+
     def write_status(self, status_list: List[DashboardSignalStatus]) -> None:
         """Write the provided status to the database."""
+        self._ensure_connection()
         insert_statement = f'''INSERT INTO `{Database.STATUS_TABLE_NAME}`
             (`signal_id`, `date`, `latest_issue`, `latest_time_value`)
             VALUES
-            (%s, %s, %s, %s)
+            {{values}}
             ON DUPLICATE KEY UPDATE
                 `latest_issue`=VALUES(`latest_issue`),
                 `latest_time_value`=VALUES(`latest_time_value`)
             '''
-        status_as_tuples = [
-            (x.signal_id, x.date, x.latest_issue, x.latest_time_value)
-            for x in status_list]
-        self._cursor.executemany(insert_statement, status_as_tuples)
-
-        latest_status_dates = {}
-        for x in status_list:
-            latest_status_date = latest_status_dates.get(x.signal_id)
-            if not latest_status_date or x.date > latest_status_date:
-                latest_status_dates.update({x.signal_id: x.date})
-        latest_status_tuples = [(v, k) for k, v in latest_status_dates.items()]
-
-        update_statement = f'''UPDATE `{Database.SIGNAL_TABLE_NAME}`
-            SET `latest_status_update` = GREATEST(`latest_status_update`, %s)
-            WHERE `id` =  %s
-            '''
-        self._cursor.executemany(update_statement, latest_status_tuples)
+        status_as_tuples = list(map(
+            attrgetter('signal_id', 'date', 'latest_issue', 'latest_time_value'),
+            status_list))
+        self._insert_rows(insert_statement, "(%s, %s, %s, %s)", status_as_tuples)
 
-        self._connection.commit()
+        signal_ids = sorted({x.signal_id for x in status_list})
+        self._update_latest_date(
+            'latest_status_update', Database.STATUS_TABLE_NAME, signal_ids)
 
     def write_coverage(
             self, coverage_list: List[DashboardSignalCoverage]) -> None:
-        """Write the provided coverage to the database."""
+        """Write the provided coverage to the database.
+
+        Older coverage of the written signals is removed, but their
+        `latest_coverage_update` is left to `update_latest_coverage`.
+        """
+        self._ensure_connection()
         insert_statement = f'''INSERT INTO `{Database.COVERAGE_TABLE_NAME}`
             (`signal_id`, `date`, `geo_type`, `count`)
             VALUES
-            (%s, %s, %s, %s)
+            {{values}}
             ON DUPLICATE KEY UPDATE `count` = VALUES(`count`)
             '''
-        coverage_as_tuples = [
-            (x.signal_id, x.date, x.geo_type, x.count)
-            for x in coverage_list]
-        self._cursor.executemany(insert_statement, coverage_as_tuples)
+        coverage_as_tuples = list(map(
+            attrgetter('signal_id', 'date', 'geo_type', 'count'),
+            coverage_list))
+        self._insert_rows(insert_statement, "(%s, %s, %s, %s)", coverage_as_tuples)
 
-        latest_coverage_dates = {}
         oldest_coverage_dates = {}
         for x in coverage_list:
-            latest_coverage_date = latest_coverage_dates.get(x.signal_id)
             oldest_coverage_date = oldest_coverage_dates.get(x.signal_id)
-            if not latest_coverage_date or x.date > latest_coverage_date:
-                latest_coverage_dates.update({x.signal_id: x.date})
-            if not oldest_coverage_date or x.date < oldest_coverage_date:
-                oldest_coverage_dates.update({x.signal_id: x.date})
+            if oldest_coverage_date is None or x.date < oldest_coverage_date:
+                oldest_coverage_dates[x.signal_id] = x.date
 
-        latest_coverage_tuples = [(v, k) for k, v in latest_coverage_dates.items()]
-        oldest_coverage_tuples = [(v, k) for k, v in oldest_coverage_dates.items()]
-
-        update_statement = f'''UPDATE `{Database.SIGNAL_TABLE_NAME}`
-            SET `latest_coverage_update` = GREATEST(`latest_coverage_update`, %s)
-            WHERE `id` =  %s
-            '''
-        self._cursor.executemany(update_statement, latest_coverage_tuples)
+        oldest_coverage_tuples = list(zip(
+            oldest_coverage_dates.values(), oldest_coverage_dates.keys()))
 
         delete_statement = f'''DELETE FROM `{Database.COVERAGE_TABLE_NAME}`
             WHERE `date` < %s
             AND `signal_id` = %s
             '''
-        self._cursor.executemany(delete_statement, oldest_coverage_tuples)
+        self._prepared_cursor.executemany(delete_statement, oldest_coverage_tuples)
 
-        self._connection.commit()
+    def update_latest_coverage(self, signal_ids: Sequence[int]) -> None:
+        """Advance `latest_coverage_update` of the given signals to their newest coverage."""
+        self._ensure_connection()
+        self._update_latest_date(
+            'latest_coverage_update', Database.COVERAGE_TABLE_NAME, signal_ids)
 
     def get_enabled_signals(self) -> List[DashboardSignal]:
         """Retrieve all enabled signals from the database"""
+        self._ensure_connection()
         select_statement = f'''SELECT `id`,
             `name`,
             `source`,
@@ -164,15 +263,12 @@ class Database:
             '''
         self._cursor.execute(select_statement)
         enabled_signals = []
-        for result in self._cursor.fetchall():
-            enabled_signals.append(
-                DashboardSignal(
-                    db_id=result[0],
-                    name=result[1],
-                    source=result[2],
-                    covidcast_signal=result[3],
-                    latest_coverage_update=result[4],
-                    latest_status_update=result[5]))
+        while True:
+            # selected columns are in `DashboardSignal` field order
+            rows = self._cursor.fetchmany(Database.FETCH_BATCH_SIZE)
+            if not rows:
+                break
+            enabled_signals.extend(starmap(DashboardSignal, rows))
         return enabled_signals
 
 
@@ -183,26 +279,64 @@ def get_argument_parser():
     return parser
 
 
-def get_latest_issue_from_metadata(dashboard_signal, metadata):
+def time_value_to_date(time_value: int, time_type: str = "day") -> datetime.date:
+    """Convert a YYYYMMDD day or YYYYWW epiweek time value to a date."""
+    if time_type == "week":
+        return Week(time_value // 100, time_value % 100).startdate()
+    year, month_day = divmod(int(time_value), 10000)
+    month, day = divmod(month_day, 100)
+    return datetime.date(year, month, day)
+
+
+def fetch_metadata(dashboard_signals: List[DashboardSignal]) -> pd.DataFrame:
+    """Download the metadata columns needed for the given signals."""
+    # an empty `signals` filter would return the metadata of every signal
+    if not dashboard_signals:
+        return pd.DataFrame(columns=METADATA_COLUMNS)
+    signals = ",".join(
+        f"{x.source}:{x.covidcast_signal}" for x in dashboard_signals)
+    try:
+        return pd.read_csv(METADATA_URL.format(signals=signals))
+    except pd.errors.EmptyDataError:
+        # none of the signals have metadata
+        return pd.DataFrame(columns=METADATA_COLUMNS)
+
+
+def summarize_metadata(metadata: pd.DataFrame) -> pd.DataFrame:
+    """Reduce the metadata to one row per (source, signal) pair."""
+    return metadata.groupby(['data_source', 'signal'], sort=False).agg(
+        time_type=('time_type', 'first'),
+        max_issue=('max_issue', 'max'),
+        max_time=('max_time', 'max'))
+
+
+def get_latest_issue_from_metadata(dashboard_signal, metadata_summary):
     """Get the most recent issue date for the signal."""
-    df_for_source = metadata[(metadata.data_source == dashboard_signal.source) & (
-        metadata.signal == dashboard_signal.covidcast_signal)]
-    max_issue = df_for_source["max_issue"].max()
-    return pd.to_datetime(str(max_issue), format="%Y%m%d").date()
+    signal_metadata = metadata_summary.loc[
+        (dashboard_signal.source, dashboard_signal.covidcast_signal)]
+    return time_value_to_date(
+        int(signal_metadata["max_issue"]), signal_metadata["time_type"])
 
 
-def get_latest_time_value_from_metadata(dashboard_signal, metadata):
+def get_latest_time_value_from_metadata(dashboard_signal, metadata_summary):
     """Get the most recent date with data for the signal."""
-    df_for_source = metadata[(metadata.data_source == dashboard_signal.source) & (
-        metadata.signal == dashboard_signal.covidcast_signal)]
-    return df_for_source["max_time"].max().date()
+    signal_metadata = metadata_summary.loc[
+        (dashboard_signal.source, dashboard_signal.covidcast_signal)]
+    return time_value_to_date(
+        int(signal_metadata["max_time"]), signal_metadata["time_type"])
 
 
-def get_coverage(dashboard_signal: DashboardSignal) -> List[DashboardSignalCoverage]:
-    """Get the most recent coverage for the signal."""
-    count_by_geo_type_df = pd.read_csv(
+def fetch_coverage(dashboard_signal: DashboardSignal) -> pd.DataFrame:
+    """Download the recent coverage counts for the signal."""
+    return pd.read_csv(
         COVERAGE_URL.format(source=dashboard_signal.source,
-                            signal=dashboard_signal.covidcast_signal))
+                            signal=dashboard_signal.covidcast_signal),
+        usecols=["time_value", "count"])
+
+
+def get_coverage(dashboard_signal: DashboardSignal,
+                 count_by_geo_type_df: pd.DataFrame) -> List[DashboardSignalCoverage]:
+    """Get the most recent coverage for the signal from the fetched counts."""
     try:
         count_by_geo_type_df["time_value"] = count_by_geo_type_df["time_value"].apply(
             lambda x: pd.to_datetime(str(x), format="%Y%m%d"))
@@ -210,17 +344,26 @@ def get_coverage(dashboard_signal: DashboardSignal) -> List[DashboardSignalCover
         count_by_geo_type_df["time_value"] = count_by_geo_type_df["time_value"].apply(
             lambda x: pd.to_datetime(Week(x // 100, x % 100).startdate()))
 
-    signal_coverage_list = []
-
-    for _, row in count_by_geo_type_df.iterrows():
-        signal_coverage = DashboardSignalCoverage(
+    # read the columns directly rather than building a Series per row
+    return [
+        DashboardSignalCoverage(
             signal_id=dashboard_signal.db_id,
-            date=row['time_value'].date(),
+            date=time_value.date(),
             geo_type='county',
-            count=row['count'])
-        signal_coverage_list.append(signal_coverage)
+            count=count)
+        for time_value, count in zip(
+            count_by_geo_type_df["time_value"],
+            count_by_geo_type_df["count"].tolist())]
 
-    return signal_coverage_list
+
+def store_coverage(database: Database,
+                   coverage_list: List[DashboardSignalCoverage], logger) -> None:
+    """Write a batch of coverage, logging rather than raising database errors."""
+    try:
+        database.write_coverage(coverage_list)
+        logger.info("Wrote coverage.", rows=len(coverage_list))
+    except mysql.connector.Error as exception:
+        logger.exception(exception)
 
 
 def main(args):
@@ -239,42 +382,77 @@ def main(args):
 
     database = Database()
 
-    signals_to_generate = database.get_enabled_signals()
+    try:
+        signals_to_generate = database.get_enabled_signals()
+    finally:
+        # the connection is released while the metadata is downloaded
+        database.close()
     logger.info("Starting generating dashboard data.", enabled_signals=[
                 signal.name for signal in signals_to_generate])
 
-    metadata = covidcast.metadata()
+    metadata_summary = summarize_metadata(fetch_metadata(signals_to_generate))
 
     signal_status_list: List[DashboardSignalStatus] = []
-    coverage_list: List[DashboardSignalCoverage] = []
+
+    today = datetime.date.today()
 
     for dashboard_signal in signals_to_generate:
+        if (dashboard_signal.source,
+                dashboard_signal.covidcast_signal) not in metadata_summary.index:
+            logger.warning(
+                "No metadata for signal, skipping its status.",
+                signal=dashboard_signal.name)
+            continue
         latest_issue = get_latest_issue_from_metadata(
             dashboard_signal,
-            metadata)
+            metadata_summary)
         latest_time_value = get_latest_time_value_from_metadata(
-            dashboard_signal, metadata)
-        latest_coverage = get_coverage(dashboard_signal)
+            dashboard_signal, metadata_summary)
 
         signal_status_list.append(
             DashboardSignalStatus(
                 signal_id=dashboard_signal.db_id,
-                date=datetime.date.today(),
+                date=today,
                 latest_issue=latest_issue,
                 latest_time_value=latest_time_value))
-        coverage_list.extend(latest_coverage)
-
-    try:
-        database.write_status(signal_status_list)
-        logger.info("Wrote status.", rowcount=database.rowcount())
-    except mysql.connector.Error as exception:
-        logger.exception(exception)
 
-    try:
-        database.write_coverage(coverage_list)
-        logger.info("Wrote coverage.", rowcount=database.rowcount())
-    except mysql.connector.Error as exception:
-        logger.exception(exception)
+    # status and coverage are committed in a single transaction, which is
+    # rolled back if a download fails
+    with database.session():
+        # coverage downloads are I/O-bound, so fan them out and write the
+        # results as they arrive, overlapping the downloads with the writes
+        covered_signal_ids = set()
+        with ThreadPoolExecutor(max_workers=COVERAGE_FETCH_WORKERS) as executor:
+            coverage_futures = {
+                executor.submit(fetch_coverage, dashboard_signal): dashboard_signal
+                for dashboard_signal in signals_to_generate}
+
+            coverage_list: List[DashboardSignalCoverage] = []
+            for future in as_completed(coverage_futures):
+                # all rows of a signal go into the same write, since writing
+                # coverage deletes the signal's older rows
+                latest_coverage = get_coverage(
+                    coverage_futures[future], future.result())
+                covered_signal_ids.update(x.signal_id for x in latest_coverage)
+                coverage_list.extend(latest_coverage)
+                if len(coverage_list) >= COVERAGE_WRITE_BATCH_SIZE:
+                    store_coverage(database, coverage_list, logger)
+                    coverage_list = []
+            if coverage_list:
+                store_coverage(database, coverage_list, logger)
+
+        # batches above only touch the coverage table, so `dashboard_signal`
+        # rows are not locked until all downloads are done
+        try:
+            database.update_latest_coverage(sorted(covered_signal_ids))
+        except mysql.connector.Error as exception:
+            logger.exception(exception)
+
+        try:
+            database.write_status(signal_status_list)
+            logger.info("Wrote status.", rowcount=database.rowcount())
+        except mysql.connector.Error as exception:
+            logger.exception(exception)
 
     logger.info(
         "Generated signal dashboard data",
@@ -13,14 +13,19 @@ import pandas as pd
 
 # first party
 from delphi.epidata.maintenance.signal_dash_data_generator import (
+  BASE_COVIDCAST,
   get_argument_parser,
   Database,
   DashboardSignalStatus,
   DashboardSignalCoverage,
   DashboardSignal,
+  summarize_metadata,
   get_latest_issue_from_metadata,
   get_latest_time_value_from_metadata,
-  get_coverage
+  fetch_metadata,
+  fetch_coverage,
+  get_coverage,
+  main
  )
 
 # py3tester coverage target
@@ -37,6 +42,62 @@ class UnitTests(unittest.TestCase):
 
         self.assertIsInstance(get_argument_parser(), argparse.ArgumentParser)
 
+    def test_writes_committed_on_flush(self):
+        """Test writes are only committed by flush."""
+        mock_connector = MagicMock()
+        database = Database(connector_impl=mock_connector)
+        database.write_status([])
+        self.assertFalse(mock_connector.connect.call_args.kwargs["autocommit"])
+        connection = mock_connector.connect()
+
+        database.write_coverage([])
+        connection.commit.assert_not_called()
+
+        database.flush()
+        connection.commit.assert_called_once()
+
+    def test_connection_opened_lazily(self):
+        """Test the connection is only opened when first used."""
+        mock_connector = MagicMock()
+        database = Database(connector_impl=mock_connector)
+        mock_connector.connect.assert_not_called()
+        database.flush()
+        mock_connector.connect.assert_not_called()
+
+        with database.session():
+            database.write_status([])
+            database.write_coverage([])
+        mock_connector.connect.assert_called_once()
+        connection = mock_connector.connect.return_value
+        connection.commit.assert_called_once()
+        connection.close.assert_called_once()
+
+    def test_session_rolled_back_on_error(self):
+        """Test a failing session discards its writes and still closes."""
+        mock_connector = MagicMock()
+        database = Database(connector_impl=mock_connector)
+        connection = mock_connector.connect.return_value
+
+        with self.assertRaises(RuntimeError):
+            with database.session():
+                database.write_status([])
+                raise RuntimeError("download failed")
+        connection.rollback.assert_called_once()
+        connection.commit.assert_not_called()
+        connection.close.assert_called_once()
+
+    def test_session_closed_when_commit_fails(self):
+        """Test the connection is closed even if the final commit fails."""
+        mock_connector = MagicMock()
+        database = Database(connector_impl=mock_connector)
+        connection = mock_connector.connect.return_value
+        connection.commit.side_effect = RuntimeError("connection lost")
+
+        with self.assertRaises(RuntimeError):
+            with database.session():
+                database.write_status([])
+        connection.close.assert_called_once()
+
     def test_insert_status_successful(self):
         """Test status data inserted correctly."""
         mock_connector = MagicMock()
@@ -56,19 +117,47 @@ class UnitTests(unittest.TestCase):
                 2021, 1, 3))
         database.write_status([status1, status2])
 
-        tuples = cursor.executemany.call_args_list[0].args[1]
-        expected_tuples = [
-            (1, date(2020, 1, 1), date(2020, 1, 2), date(2020, 1, 3)),
-            (2, date(2021, 1, 1), date(2021, 1, 2), date(2021, 1, 3))
+        insert_params = cursor.execute.call_args_list[0].args[1]
+        expected_params = [
+            1, date(2020, 1, 1), date(2020, 1, 2), date(2020, 1, 3),
+            2, date(2021, 1, 1), date(2021, 1, 2), date(2021, 1, 3)
         ]
-        self.assertListEqual(tuples, expected_tuples)
+        self.assertListEqual(insert_params, expected_params)
 
-        update_tuples = cursor.executemany.call_args_list[1].args[1]
-        expected_update_tuples = [
-            (date(2020, 1, 1), 1),
-            (date(2021, 1, 1), 2)
-        ]
-        self.assertListEqual(update_tuples, expected_update_tuples)
+        update_statement, update_params = cursor.execute.call_args_list[1].args
+        self.assertIn("`latest_status_update`", update_statement)
+        self.assertIn("FROM `dashboard_signal_status`", update_statement)
+        self.assertListEqual(update_params, [1, 2])
+
+    def test_insert_status_batched(self):
+        """Test status rows are split into multi-row statements."""
+        mock_connector = MagicMock()
+        database = Database(connector_impl=mock_connector)
+        connection = mock_connector.connect()
+        cursor = connection.cursor()
+
+        status_list = [
+            DashboardSignalStatus(
+                signal_id=i, date=date(2020, 1, 1),
+                latest_issue=date(2020, 1, 2),
+                latest_time_value=date(2020, 1, 3))
+            for i in range(3)]
+        with patch.object(Database, "INSERT_BATCH_SIZE", 2):
+            database.write_status(status_list)
+
+        # two multi-row INSERTs followed by one UPDATE ... JOIN
+        self.assertEqual(cursor.execute.call_count, 3)
+        insert_calls = cursor.execute.call_args_list[:2]
+        first_statement, first_params = insert_calls[0].args
+        second_statement, second_params = insert_calls[1].args
+        self.assertEqual(first_statement.count("(%s, %s, %s, %s)"), 2)
+        self.assertEqual(second_statement.count("(%s, %s, %s, %s)"), 1)
+        self.assertEqual(len(first_params), 8)
+        self.assertEqual(len(second_params), 4)
+
+        update_statement, update_params = cursor.execute.call_args_list[2].args
+        self.assertIn("JOIN", update_statement)
+        self.assertListEqual(update_params, [0, 1, 2])
 
     def test_insert_coverage_successful(self):
         """Test coverage data inserted correctly."""
@@ -98,28 +187,37 @@ class UnitTests(unittest.TestCase):
 
         database.write_coverage([coverage1, coverage2, coverage3])
 
-        coverage_tuples = cursor.executemany.call_args_list[0].args[1]
-        expected_coverage_tuples = [
-            (1, date(2020, 1, 1), "state", 1),
-            (2, date(2021, 2, 2), "state", 1),
-            (2, date(2021, 2, 1), "state", 1)
+        insert_params = cursor.execute.call_args_list[0].args[1]
+        expected_params = [
+            1, date(2020, 1, 1), "state", 1,
+            2, date(2021, 2, 2), "state", 1,
+            2, date(2021, 2, 1), "state", 1
         ]
-        self.assertListEqual(coverage_tuples, expected_coverage_tuples)
+        self.assertListEqual(insert_params, expected_params)
+        # `dashboard_signal` is left to `update_latest_coverage`
+        self.assertEqual(cursor.execute.call_count, 1)
 
-        update_tuples = cursor.executemany.call_args_list[1].args[1]
-        expected_update_tuples = [
-            (date(2020, 1, 1), 1),
-            (date(2021, 2, 2), 2)
-        ]
-        self.assertListEqual(update_tuples, expected_update_tuples)
-
-        delete_tuples = cursor.executemany.call_args_list[2].args[1]
+        delete_tuples = cursor.executemany.call_args_list[0].args[1]
         expected_delete_tuples = [
             (date(2020, 1, 1), 1),
             (date(2021, 2, 1), 2)
         ]
         self.assertListEqual(delete_tuples, expected_delete_tuples)
 
+    def test_update_latest_coverage(self):
+        """Test latest coverage dates are updated in one statement."""
+        mock_connector = MagicMock()
+        database = Database(connector_impl=mock_connector)
+        connection = mock_connector.connect()
+        cursor = connection.cursor()
+
+        database.update_latest_coverage([1, 2])
+
+        update_statement, update_params = cursor.execute.call_args.args
+        self.assertIn("`latest_coverage_update`", update_statement)
+        self.assertIn("FROM `dashboard_signal_coverage`", update_statement)
+        self.assertListEqual(update_params, [1, 2])
+
     def test_get_enabled_signals_successful(self):
         """Test signals retrieved correctly."""
         mock_connector = MagicMock()
@@ -131,7 +229,7 @@ class UnitTests(unittest.TestCase):
             (1, "Change", "chng", "chng-sig", date(2020, 1, 1), date(2020, 1, 2)),
             (2, "Quidel", "quidel", "quidel-sig", date(2020, 2, 1), date(2020, 2, 2)),
         ]
-        cursor.fetchall.return_value = db_rows
+        cursor.fetchmany.side_effect = [db_rows, []]
 
         signals = database.get_enabled_signals()
 
@@ -158,12 +256,16 @@ class UnitTests(unittest.TestCase):
             covidcast_signal="chng-sig",
             latest_coverage_update=date(2021, 1, 1),
             latest_status_update=date(2021, 1, 1))
-        data = [['chng', 'chng-sig', 20200101],
-                ['chng', 'chng-sig', 20210101],
-                ['quidel', 'quidel-sig', 20220101]]
-        metadata = pd.DataFrame(data, columns=['data_source', 'signal', 'max_issue'])
+        data = [['chng', 'chng-sig', 'day', 20200101, 20200101],
+                ['chng', 'chng-sig', 'day', 20210101, 20210101],
+                ['chng', 'other-sig', 'day', 20220101, 20220101],
+                ['quidel', 'quidel-sig', 'day', 20220101, 20220101]]
+        metadata = pd.DataFrame(
+            data,
+            columns=['data_source', 'signal', 'time_type', 'max_issue', 'max_time'])
 
-        issue_date = get_latest_issue_from_metadata(signal, metadata)
+        issue_date = get_latest_issue_from_metadata(
+            signal, summarize_metadata(metadata))
         self.assertEqual(issue_date, date(2021, 1, 1))
 
     def test_get_latest_time_value_from_metadata(self):
@@ -173,17 +275,107 @@ class UnitTests(unittest.TestCase):
             latest_coverage_update=date(2021, 1, 1),
             latest_status_update=date(2021, 1, 1))
         data = [
-            ['chng', 'chng-sig', pd.Timestamp("2020-01-01")],
-            ['chng', 'chng-sig', pd.Timestamp("2021-01-01")],
-            ['quidel', 'quidel-sig', pd.Timestamp("20220101")]]
-        metadata = pd.DataFrame(data, columns=['data_source', 'signal', 'max_time'])
+            ['chng', 'chng-sig', 'day', 20200101, 20200101],
+            ['chng', 'chng-sig', 'day', 20210101, 20210101],
+            ['chng', 'other-sig', 'day', 20220101, 20220101],
+            ['quidel', 'quidel-sig', 'day', 20220101, 20220101]]
+        metadata = pd.DataFrame(
+            data,
+            columns=['data_source', 'signal', 'time_type', 'max_issue', 'max_time'])
 
-        data_date = get_latest_time_value_from_metadata(signal, metadata)
+        data_date = get_latest_time_value_from_metadata(
+            signal, summarize_metadata(metadata))
         self.assertEqual(data_date, date(2021, 1, 1))
 
-    #@patch("covidcast.signal")
+    def test_get_latest_dates_from_weekly_metadata(self):
+        signal = DashboardSignal(
+            db_id=1, name="NSSP", source="nssp",
+            covidcast_signal="nssp-sig",
+            latest_coverage_update=date(2021, 1, 1),
+            latest_status_update=date(2021, 1, 1))
+        data = [
+            ['nssp', 'nssp-sig', 'week', 202401, 202352],
+            ['nssp', 'nssp-sig', 'week', 202402, 202401]]
+        metadata = pd.DataFrame(
+            data,
+            columns=['data_source', 'signal', 'time_type', 'max_issue', 'max_time'])
+        metadata_summary = summarize_metadata(metadata)
+
+        self.assertEqual(
+            get_latest_issue_from_metadata(signal, metadata_summary),
+            date(2024, 1, 7))
+        self.assertEqual(
+            get_latest_time_value_from_metadata(signal, metadata_summary),
+            date(2023, 12, 31))
+
+    @patch("pandas.read_csv")
+    def test_fetch_metadata(self, mock_read_csv):
+        signals = [
+            DashboardSignal(
+                db_id=1, name="Change", source="chng",
+                covidcast_signal="chng-sig",
+                latest_coverage_update=date(2021, 1, 1),
+                latest_status_update=date(2021, 1, 1)),
+            DashboardSignal(
+                db_id=2, name="Quidel", source="quidel",
+                covidcast_signal="quidel-sig",
+                latest_coverage_update=date(2021, 1, 1),
+                latest_status_update=date(2021, 1, 1))]
+
+        fetch_metadata(signals)
+
+        url = mock_read_csv.call_args.args[0]
+        self.assertIn("signals=chng:chng-sig,quidel:quidel-sig", url)
+        self.assertIn("fields=data_source,signal,time_type,max_time,max_issue", url)
+
+    @patch("pandas.read_csv")
+    def test_fetch_metadata_without_signals(self, mock_read_csv):
+        metadata = fetch_metadata([])
+
+        mock_read_csv.assert_not_called()
+        self.assertTrue(metadata.empty)
+        self.assertListEqual(
+            list(metadata.columns),
+            ['data_source', 'signal', 'time_type', 'max_time', 'max_issue'])
+
     @patch("pandas.read_csv")
-    def test_get_coverage(self, mock_signal):
+    def test_fetch_metadata_without_matches(self, mock_read_csv):
+        signal = DashboardSignal(
+            db_id=1, name="Change", source="chng",
+            covidcast_signal="chng-sig",
+            latest_coverage_update=date(2021, 1, 1),
+            latest_status_update=date(2021, 1, 1))
+        mock_read_csv.side_effect = pd.errors.EmptyDataError(
+            "No columns to parse from file")
+
+        metadata = fetch_metadata([signal])
+
+        self.assertTrue(metadata.empty)
+        self.assertNotIn(
+            ('chng', 'chng-sig'), summarize_metadata(metadata).index)
+
+    @patch("pandas.read_csv")
+    def test_fetch_coverage(self, mock_read_csv):
+        signal = DashboardSignal(
+            db_id=1, name="Change", source="chng",
+            covidcast_signal="chng-sig",
+            latest_coverage_update=date(2021, 1, 1),
+            latest_status_update=date(2021, 1, 1))
+        epidata_df = pd.DataFrame(
+            [['chng', 'chng-sig', 20200101, 2]],
+            columns=['source', 'signal', 'time_value', 'count'])
+        mock_read_csv.return_value = epidata_df
+
+        self.assertIs(fetch_coverage(signal), epidata_df)
+        url = mock_read_csv.call_args.args[0]
+        self.assertEqual(
+            url,
+            f"{BASE_COVIDCAST}/coverage?format=csv&signal=chng:chng-sig"
+            + "&fields=time_value,count&days=56")
+        self.assertEqual(
+            mock_read_csv.call_args.kwargs["usecols"], ["time_value", "count"])
+
+    def test_get_coverage(self):
         signal = DashboardSignal(
             db_id=1, name="Change", source="chng",
             covidcast_signal="chng-sig",
@@ -209,9 +401,7 @@ class UnitTests(unittest.TestCase):
                 'time_value',
                 'count'])
 
-        mock_signal.return_value = epidata_df
-
-        coverage = get_coverage(signal)
+        coverage = get_coverage(signal, epidata_df)
 
         expected_coverage = [
             DashboardSignalCoverage(
@@ -233,4 +423,52 @@ class UnitTests(unittest.TestCase):
             ]
 
         self.assertListEqual(coverage, expected_coverage)
-     
+
+    @patch("delphi.epidata.maintenance.signal_dash_data_generator.COVERAGE_WRITE_BATCH_SIZE", 3)
+    @patch("delphi.epidata.maintenance.signal_dash_data_generator.get_structured_logger")
+    @patch("delphi.epidata.maintenance.signal_dash_data_generator.fetch_coverage")
+    @patch("delphi.epidata.maintenance.signal_dash_data_generator.fetch_metadata")
+    @patch("mysql.connector.connect")
+    def test_main_writes_whole_signals_per_batch(
+            self, mock_connect, mock_metadata, mock_fetch_coverage, mock_logger):
+        """Test main batches coverage by signal and commits once."""
+        connection = mock_connect.return_value
+        cursor = connection.cursor.return_value
+        cursor.fetchmany.side_effect = [[
+            (1, "Change", "chng", "chng-sig", date(2020, 1, 1), date(2020, 1, 1)),
+            (2, "Quidel", "quidel", "quidel-sig", date(2020, 1, 1), date(2020, 1, 1)),
+            (3, "HHS", "hhs", "hhs-sig", date(2020, 1, 1), date(2020, 1, 1))
+        ], []]
+        # `hhs-sig` has no metadata
+        mock_metadata.return_value = pd.DataFrame(
+            [['chng', 'chng-sig', 'day', 20200101, 20200102],
+             ['quidel', 'quidel-sig', 'day', 20200101, 20200102]],
+            columns=['data_source', 'signal', 'time_type', 'max_time', 'max_issue'])
+        rows_per_signal = {1: 2, 2: 2, 3: 1}
+        mock_fetch_coverage.side_effect = lambda dashboard_signal: pd.DataFrame({
+            "time_value": [20200101 + i
+                           for i in range(rows_per_signal[dashboard_signal.db_id])],
+            "count": 1})
+
+        with patch.object(Database, "write_coverage", autospec=True) as mock_write, \
+                patch.object(Database, "write_status", autospec=True) as mock_status:
+            self.assertTrue(main(None))
+
+        # status is only written for signals with metadata
+        status_list = mock_status.call_args.args[1]
+        self.assertListEqual([x.signal_id for x in status_list], [1, 2])
+        mock_logger.return_value.warning.assert_called_once()
+
+        batches = [call.args[1] for call in mock_write.call_args_list]
+        self.assertEqual(sum(map(len, batches)), 5)
+        # a signal's rows are never split across writes
+        for signal_id in rows_per_signal:
+            self.assertEqual(
+                sum(any(x.signal_id == signal_id for x in batch) for batch in batches), 1)
+        # a batch is written as soon as it reaches the batch size
+        self.assertEqual(len(batches), 2)
+        self.assertGreaterEqual(len(batches[0]), 3)
+        connection.commit.assert_called_once()
+        connection.rollback.assert_not_called()
+        # once after reading the signals and once after the writes
+        self.assertEqual(connection.close.call_count, 2)